@@ -1,16 +1,29 @@
 import os
 import asyncio
-import aiofiles
+import base64
+import csv
 import json
 import argparse
+import random
+import re
+import sqlite3
 import subprocess
 import time
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import vertexai
-from vertexai.generative_models import GenerativeModel
+from vertexai.generative_models import FinishReason, GenerationConfig, GenerativeModel
+from google.api_core import exceptions as gexc
 from google.oauth2.credentials import Credentials
-from aiocsv import AsyncReader, AsyncDictWriter
+
+# orjson encodes/decodes several times faster; fall back to stdlib json
+try:
+    from orjson import dumps as _orjson_dumps, loads as json_loads
+
+    def json_dumps(value) -> str:
+        return _orjson_dumps(value).decode()
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
 
 # --- HARDCODED CONFIGURATION ---
 # Update these values for your environment
@@ -19,6 +32,21 @@ VERTEX_API_ENDPOINT = ""
 VERTEX_MODEL_NAME = "gemini-1.5-pro-002"
 CA_BUNDLE_PATH = r"C:\citi_ca_certs\citiInternalCAchain_PROD.pem"
 
+# Retry settings for failed API calls (full-jitter exponential backoff)
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+# Only throttling and transient server errors can succeed on a later attempt
+RETRYABLE_ERRORS = (
+    gexc.TooManyRequests,
+    gexc.ResourceExhausted,
+    gexc.ServiceUnavailable,
+    gexc.DeadlineExceeded,
+    gexc.InternalServerError,
+    gexc.Aborted,
+)
+
 # Set CA bundle if on Windows
 if os.name == "nt" and os.path.exists(CA_BUNDLE_PATH):
     os.environ["REQUESTS_CA_BUNDLE"] = CA_BUNDLE_PATH
@@ -26,28 +54,33 @@ if os.name == "nt" and os.path.exists(CA_BUNDLE_PATH):
 # Global model instance
 _vertex_model: Optional[GenerativeModel] = None
 
+# Credentials shared with the Vertex client; the token is swapped in place before it expires
+_credentials: Optional[Credentials] = None
+_token_expires_at = 0.0
+TOKEN_DEFAULT_TTL = 3600.0
+TOKEN_REFRESH_MARGIN = 300.0
+
+OUTPUT_FIELDNAMES = ["address", "shortForm", "longForm", "confidence", "error"]
+
+# Error prefixes of rows whose call never produced an answer; a resumed run retries these
+BATCH_FAILED_ERROR = "Batch failed"
+NO_RESULT_ERROR = "No result produced"
+
+# Output is flushed to disk after this many rows or seconds, whichever comes first
+FLUSH_EVERY_ROWS = 500
+FLUSH_INTERVAL = 1.0
+
+# Keys per cache query; SQLite before 3.32 allows at most 999 bound variables
+CACHE_LOOKUP_CHUNK = 500
+
+# Results below this confidence are reported as errors (and never cached)
+MIN_CONFIDENCE = 0.7
+
 SYSTEM_PROMPT = """You are a highly specialized AI engine designed for one purpose: to accurately identify the country from a given address string. You must be precise and avoid making assumptions.
 
 Your task is to analyze the provided batch of addresses, which may be incomplete or in any language, and return the country information for each one.
 
-You will receive a JSON array of address strings in the user message. You MUST respond with a valid JSON object containing a single key "results". This key should hold a JSON array of objects, where each object corresponds to an address in the input array and maintains the original order.
-
-### BATCH OUTPUT JSON STRUCTURE
-Your entire response must be a single JSON object like this. Do not include any other text or explanations.
-{
-  "results": [
-{
-      "shortForm": "The 2-letter ISO 3166-1 alpha-2 country code...",
-      "longForm": "The full, official English name of the country...",
-      "confidence": "A floating-point number from 0.0 to 1.0..."
-    },
-    {
-      "shortForm": "...",
-      "longForm": "...",
-      "confidence": "..."
-    }
-  ]
-}
+You will receive a JSON array of address strings in the user message. Return one entry in "results" per address, in the original order: "shortForm" is the 2-letter ISO 3166-1 alpha-2 country code, "longForm" is the full, official English name of the country, and "confidence" is a number from 0.0 to 1.0.
 
 ### RULES FOR EACH INDIVIDUAL ADDRESS
 
@@ -100,6 +133,115 @@ For each address in the input batch, apply the following logic:
 }
 """
 
+# Enforced server-side, so the prompt no longer has to spell out the JSON layout
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "shortForm": {"type": "string"},
+                    "longForm": {"type": "string"},
+                    "confidence": {"type": "number"},
+                },
+                "required": ["shortForm", "longForm", "confidence"],
+            },
+        },
+    },
+    "required": ["results"],
+}
+
+# --- LOCAL COUNTRY DETECTION ---
+# Addresses with one unambiguous signal are answered locally instead of by the model.
+# Country names only count as the last comma-separated part (avoids "Paris, Texas"); English names
+# that are also US towns ("123 Main St, Peru") are left out, their local-language names are kept.
+# German-style "Straße, 12345 City" is not used either: South Tyrol and France share that format.
+COUNTRY_NAMES = {
+    "US": ("United States", ["United States", "United States of America", "USA", "U.S.A.", "US", "U.S."]),
+    "GB": ("United Kingdom", ["United Kingdom", "UK", "U.K.", "Great Britain", "England", "Scotland", "Wales",
+                              "Northern Ireland"]),
+    "DE": ("Germany", ["Germany", "Deutschland"]),
+    "FR": ("France", ["France"]),
+    "ES": ("Spain", ["Spain", "España", "Espana"]),
+    "IT": ("Italy", ["Italy", "Italia"]),
+    "PT": ("Portugal", ["Portugal"]),
+    "NL": ("Netherlands", ["Netherlands", "The Netherlands", "Nederland"]),
+    "BE": ("Belgium", ["Belgium", "België", "Belgique"]),
+    "CH": ("Switzerland", ["Switzerland", "Schweiz", "Suisse", "Svizzera"]),
+    "AT": ("Austria", ["Austria", "Österreich"]),
+    "IE": ("Ireland", ["Ireland", "Republic of Ireland"]),
+    "DK": ("Denmark", ["Danmark"]),
+    "SE": ("Sweden", ["Sverige"]),
+    "NO": ("Norway", ["Norge"]),
+    "FI": ("Finland", ["Finland", "Suomi"]),
+    "PL": ("Poland", ["Polska"]),
+    "CZ": ("Czechia", ["Czechia", "Czech Republic"]),
+    "GR": ("Greece", ["Ελλάδα"]),
+    "TR": ("Türkiye", ["Turkey", "Türkiye", "Turkiye"]),
+    "RU": ("Russian Federation", ["Russia", "Russian Federation"]),
+    "UA": ("Ukraine", ["Ukraine"]),
+    "CA": ("Canada", ["Canada"]),
+    "MX": ("Mexico", ["México"]),
+    "BR": ("Brazil", ["Brasil"]),
+    "AR": ("Argentina", ["Argentina"]),
+    "CL": ("Chile", ["Chile"]),
+    "CO": ("Colombia", ["Colombia"]),
+    "PE": ("Peru", ["Perú"]),
+    "EC": ("Ecuador", ["Ecuador"]),
+    "JP": ("Japan", ["Japan", "日本"]),
+    "CN": ("China", ["People's Republic of China", "PRC", "中国"]),
+    "HK": ("Hong Kong", ["Hong Kong"]),
+    "TW": ("Taiwan", ["Taiwan"]),
+    "KR": ("South Korea", ["South Korea", "Republic of Korea"]),
+    "IN": ("India", ["India"]),
+    "SG": ("Singapore", ["Singapore"]),
+    "MY": ("Malaysia", ["Malaysia"]),
+    "TH": ("Thailand", ["Thailand"]),
+    "VN": ("Vietnam", ["Vietnam", "Viet Nam"]),
+    "PH": ("Philippines", ["Philippines"]),
+    "ID": ("Indonesia", ["Indonesia"]),
+    "AU": ("Australia", ["Australia"]),
+    "NZ": ("New Zealand", ["New Zealand"]),
+    "ZA": ("South Africa", ["South Africa"]),
+    "NG": ("Nigeria", ["Nigeria"]),
+    "EG": ("Egypt", ["Egypt"]),
+    "KE": ("Kenya", ["Kenya"]),
+    "AE": ("United Arab Emirates", ["United Arab Emirates", "UAE"]),
+    "SA": ("Saudi Arabia", ["Saudi Arabia"]),
+    "IL": ("Israel", ["Israel"]),
+}
+_COUNTRY_BY_ALIAS = {
+    alias.casefold().rstrip("."): code
+    for code, (_, aliases) in COUNTRY_NAMES.items()
+    for alias in aliases
+}
+_US_STATES = (
+    "AL|AK|AZ|AR|CA|CO|CT|DE|DC|FL|GA|HI|ID|IL|IN|IA|KS|KY|LA|ME|MD|MA|MI|MN|MS|MO|MT|NE|NV|NH|NJ|NM|NY|NC|ND|"
+    "OH|OK|OR|PA|RI|SC|SD|TN|TX|UT|VT|VA|WA|WV|WI|WY|AA|AE|AP"
+)
+# One compiled alternation so each address is scanned once; group names are ISO codes
+LOCAL_DETECT_RE = re.compile(
+    r"(?:^|,)\s*(?P<country>(?i:" + "|".join(
+        re.escape(alias.rstrip("."))
+        for alias in sorted((a for _, aliases in COUNTRY_NAMES.values() for a in aliases), key=len, reverse=True)
+    ) + r"))\.?\s*$"
+    # US: state abbreviation + ZIP at the end ("Beverly Hills, CA 90210")
+    r"|(?P<us>\b(?:" + _US_STATES + r") \d{5}(?:-\d{4})?$)"
+    # UK postcode at the end ("London SW1A 2AA")
+    r"|(?P<gb>\b(?:GIR 0AA|[A-Z]{1,2}\d[A-Z\d]? \d[A-Z]{2})$)"
+    # Canadian postal code at the end ("Toronto, ON M5V 3L9")
+    r"|(?P<ca>\b[ABCEGHJ-NPRSTVXY]\d[ABCEGHJ-NPRSTV-Z] ?\d[ABCEGHJ-NPRSTV-Z]\d$)"
+    # Australian state + 4-digit postcode at the end ("Sydney, NSW, 2000")
+    r"|(?P<au>\b(?:NSW|VIC|QLD|SA|WA|TAS|NT|ACT),? \d{4}$)"
+    # Japanese prefecture at the start, optionally after a 〒 postcode
+    r"|(?P<jp>^(?:〒?\d{3}-\d{4}\s*)?(?:東京都|北海道|京都府|大阪府|[\u4e00-\u9fff]{2,3}県))"
+)
+# Matches on an explicit country name are certain; postal/street formats are strong but not absolute
+LOCAL_NAME_CONFIDENCE = 1.0
+LOCAL_FORMAT_CONFIDENCE = 0.9
+
 def get_helix_token() -> str:
     """Get helix access token"""
     try:
@@ -130,9 +272,33 @@ def get_helix_token() -> str:
     
     raise RuntimeError("Cannot get helix token. Ensure helix CLI is available.")
 
-def init_vertex():
+def token_expiry(token: str) -> float:
+    """Expiry time of a JWT access token, or a default lifetime if it can't be read"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json_loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + TOKEN_DEFAULT_TTL
+
+def token_refresh_due() -> bool:
+    """Whether the current token is close enough to expiry to be replaced"""
+    return _credentials is not None and time.time() >= _token_expires_at - TOKEN_REFRESH_MARGIN
+
+def refresh_token_if_needed():
+    """Fetch a new helix token when the current one is close to expiring (blocking call)"""
+    global _token_expires_at
+    if not token_refresh_due():
+        return
+    
+    print("🔐 Refreshing helix token...")
+    token = get_helix_token()
+    _credentials.token = token
+    _token_expires_at = token_expiry(token)
+
+def init_vertex(model_name: str = VERTEX_MODEL_NAME):
     """Initialize Vertex AI once"""
-    global _vertex_model
+    global _vertex_model, _credentials, _token_expires_at
     if _vertex_model:
         return
     
@@ -140,27 +306,102 @@ def init_vertex():
     token = get_helix_token()
     
     print("🚀 Initializing Vertex AI...")
-    credentials = Credentials(token=token)
+    _credentials = Credentials(token=token)
+    _token_expires_at = token_expiry(token)
     
     vertexai.init(
         project=VERTEX_PROJECT_ID,
-        credentials=credentials,
+        credentials=_credentials,
         api_transport="rest",
         api_endpoint=VERTEX_API_ENDPOINT,
         metadata={"x-r2d2-user": os.getenv("USERNAME", "user")}
     )
     
-    _vertex_model = GenerativeModel(VERTEX_MODEL_NAME)
+    _vertex_model = GenerativeModel(
+        model_name,
+        system_instruction=SYSTEM_PROMPT,
+        generation_config=GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=RESPONSE_SCHEMA,
+        ),
+    )
     print("✅ Vertex AI initialized")
 
-def process_addresses_sync(addresses: List[str]) -> Dict:
-    """Process addresses via Gemini (blocking call)"""
+def retry_delay(attempt: int, error: Exception) -> float:
+    """Full-jitter backoff delay, raised to the server's Retry-After hint if present"""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+async def generate_with_retry(prompt: str):
+    """Call Gemini, retrying throttled/transient failures with backoff"""
+    loop = asyncio.get_event_loop()
+    for attempt in range(MAX_RETRIES + 1):
+        if token_refresh_due():
+            # Fetching a token shells out to the helix CLI, so keep it off the event loop
+            await loop.run_in_executor(None, refresh_token_if_needed)
+        try:
+            # generate_content_async only has a gRPC client, which would bypass REQUESTS_CA_BUNDLE and
+            # the REST endpoint; run the sync REST call in the executor instead
+            return await loop.run_in_executor(None, _vertex_model.generate_content, prompt)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt, e)
+            print(f"⏳ API call failed ({e}), retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+def detect_country_locally(address: str) -> Optional[Dict]:
+    """Result for an address whose country signals all agree, or None to ask the model"""
+    found: Dict[str, float] = {}
+    for match in LOCAL_DETECT_RE.finditer(address):
+        if match.lastgroup == "country":
+            # casefold() turns a dotted capital I ("İNDIA") into "i" + U+0307; drop the combining dot
+            code = _COUNTRY_BY_ALIAS.get(match.group("country").casefold().replace("\u0307", ""))
+            if code is None:
+                return None
+            found[code] = max(found.get(code, 0.0), LOCAL_NAME_CONFIDENCE)
+        else:
+            code = match.lastgroup.upper()
+            found[code] = max(found.get(code, 0.0), LOCAL_FORMAT_CONFIDENCE)
+    
+    if len(found) != 1:
+        return None
+    code, confidence = found.popitem()
+    return {"shortForm": code, "longForm": COUNTRY_NAMES[code][0], "confidence": confidence}
+
+def pad_results(results: List[Dict], n: int) -> List[Dict]:
+    """Trim or pad a results list to exactly n entries, padding with UNKNOWN"""
+    results = results[:n]
+    return results + [
+        {"shortForm": "UNKNOWN", "longForm": "UNKNOWN", "confidence": 0.0}
+        for _ in range(n - len(results))
+    ]
+
+async def process_addresses(addresses: List[str]) -> Dict:
+    """Process addresses via Gemini"""
     init_vertex()
     
-    prompt = SYSTEM_PROMPT + "\n\nAddresses:\n" + json.dumps(addresses)
+    # The system prompt is attached to the model once; each request carries only the addresses
+    prompt = json_dumps(addresses)
     
     try:
-        response = _vertex_model.generate_content(prompt)
+        response = await generate_with_retry(prompt)
+        
+        # A response cut off at the output token limit is invalid JSON; split the batch instead
+        candidates = getattr(response, 'candidates', None)
+        if len(addresses) > 1 and candidates and candidates[0].finish_reason == FinishReason.MAX_TOKENS:
+            mid = len(addresses) // 2
+            print(f"✂️  Response truncated, splitting batch of {len(addresses)} addresses...")
+            left = (await process_addresses(addresses[:mid])).get("results", [])
+            right = (await process_addresses(addresses[mid:])).get("results", [])
+            return {"results": pad_results(left, mid) + pad_results(right, len(addresses) - mid)}
         
         # Handle different response formats
         response_text = ""
@@ -179,7 +420,7 @@ def process_addresses_sync(addresses: List[str]) -> Dict:
             response_text = response_text[:-3]
         response_text = response_text.strip()
         
-        return json.loads(response_text)
+        return json_loads(response_text)
         
     except json.JSONDecodeError as e:
         print(f"⚠️  JSON decode error: {e}")
@@ -191,37 +432,82 @@ def process_addresses_sync(addresses: List[str]) -> Dict:
                 for _ in addresses
             ]
         }
-    except Exception as e:
-        print(f"⚠️  API call failed: {e}")
-        return {
-            "results": [
-                {"shortForm": "UNKNOWN", "longForm": "UNKNOWN", "confidence": 0.0}
-                for _ in addresses
-            ]
-        }
 
-async def process_batch_with_delay(batch: List[str], batch_num: int, writer, delay: float = 2.0):
+def cache_key(address: str) -> str:
+    """Normalize an address for cache lookups (case and whitespace insensitive)"""
+    return " ".join(address.lower().split())
+
+def open_cache(path: str) -> sqlite3.Connection:
+    """Open (or create) the on-disk result cache"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS addr_cache (k TEXT PRIMARY KEY, v TEXT)")
+    conn.commit()
+    return conn
+
+def cache_lookup(conn: sqlite3.Connection, addresses: List[str]) -> Dict[str, Dict]:
+    """Return cached results for the given addresses, keyed by address (blocking call)"""
+    keys = {cache_key(address): address for address in addresses}
+    key_list = list(keys)
+    found: Dict[str, Dict] = {}
+    for i in range(0, len(key_list), CACHE_LOOKUP_CHUNK):
+        chunk = key_list[i:i + CACHE_LOOKUP_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT k, v FROM addr_cache WHERE k IN ({placeholders})", chunk).fetchall()
+        found.update((keys[k], json_loads(v)) for k, v in rows)
+    return found
+
+def cache_store(conn: sqlite3.Connection, results: Dict[str, Dict]):
+    """Store results keyed by address (blocking call)"""
+    conn.executemany(
+        "INSERT OR REPLACE INTO addr_cache (k, v) VALUES (?, ?)",
+        [(cache_key(address), json_dumps(result)) for address, result in results.items()]
+    )
+    conn.commit()
+
+async def process_batch_with_delay(batch: List[str], batch_num: int, queue: asyncio.Queue, delay: float = 2.0,
+                                   cache: Optional[sqlite3.Connection] = None):
     """Process a single batch with rate limiting"""
     try:
         print(f"🔄 Processing batch {batch_num} ({len(batch)} addresses)...")
         
-        # Add delay between batches to avoid rate limits
-        if batch_num > 1:
-            await asyncio.sleep(delay)
-        
-        # Process the batch (compatible with older Python versions)
+        # Blocking cache I/O runs in the default executor (compatible with older Python versions)
         loop = asyncio.get_event_loop()
-        response_data = await loop.run_in_executor(None, process_addresses_sync, batch)
-        results = response_data.get("results", [])
+        results_by_address: Dict[str, Dict] = {}
+        if cache is not None:
+            results_by_address = await loop.run_in_executor(None, cache_lookup, cache, batch)
+        misses = [address for address in batch if address not in results_by_address]
+        
+        if misses:
+            # Add delay between batches to avoid rate limits
+            if batch_num > 1:
+                await asyncio.sleep(delay)
+            
+            response_data = await process_addresses(misses)
+            # Validate the result count once so every address has exactly one entry
+            fresh = dict(zip(misses, pad_results(response_data.get("results") or [], len(misses))))
+            results_by_address.update(fresh)
+            
+            accepted = {
+                a: r for a, r in fresh.items()
+                if r.get("confidence", 0.0) >= MIN_CONFIDENCE and r.get("shortForm") != "UNKNOWN"
+            }
+            if cache is not None and accepted:
+                await loop.run_in_executor(None, cache_store, cache, accepted)
         
         # Write results
-        for i, address in enumerate(batch):
-            result_line = {"address": address}
-            if i < len(results) and results[i].get("confidence", 0.0) >= 0.7:
-                result_line.update(results[i])
+        for address in batch:
+            r = results_by_address[address]
+            if r.get("confidence", 0.0) >= MIN_CONFIDENCE and r.get("shortForm") != "UNKNOWN":
+                result_line = {
+                    "address": address,
+                    "shortForm": r["shortForm"],
+                    "longForm": r["longForm"],
+                    "confidence": r["confidence"],
+                }
             else:
-                result_line["error"] = "Low confidence or processing error"
-            await writer.writerow(result_line)
+                result_line = {"address": address, "error": "Low confidence or processing error"}
+            await queue.put(result_line)
         
         print(f"✅ Batch {batch_num} completed")
         
@@ -229,28 +515,164 @@ async def process_batch_with_delay(batch: List[str], batch_num: int, writer, del
         print(f"❌ Batch {batch_num} failed: {e}")
         # Write error for all addresses in failed batch
         for address in batch:
-            await writer.writerow({
+            await queue.put({
                 "address": address, 
-                "error": f"Batch failed: {str(e)}"
+                "error": f"{BATCH_FAILED_ERROR}: {str(e)}"
             })
 
-def create_batches(items: List[str], size: int) -> List[List[str]]:
-    """Split items into batches"""
-    return [items[i:i + size] for i in range(0, len(items), size)]
+async def drain_results(queue: asyncio.Queue, writer: csv.DictWriter, f, addresses: List[str],
+                        known: Optional[Dict[str, Dict]] = None):
+    """Single consumer that writes one row per input address, in input order, until it receives None"""
+    loop = asyncio.get_event_loop()
+    results: Dict[str, Dict] = dict(known or {})
+    next_index = 0
+    flushed_index = 0
+    last_flush = loop.time()
+    while True:
+        try:
+            row = await asyncio.wait_for(queue.get(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            # Idle while a batch is in flight; make sure what we have reaches disk
+            if next_index > flushed_index:
+                f.flush()
+                flushed_index = next_index
+            last_flush = loop.time()
+            continue
+        if row is not None:
+            results[row["address"]] = row
+        
+        # Emit every input row whose (possibly shared) result is now known
+        while next_index < len(addresses) and addresses[next_index] in results:
+            writer.writerow(results[addresses[next_index]])
+            next_index += 1
+        
+        if next_index - flushed_index >= FLUSH_EVERY_ROWS or loop.time() - last_flush >= FLUSH_INTERVAL:
+            f.flush()
+            flushed_index = next_index
+            last_flush = loop.time()
+        
+        if row is None:
+            break
+    
+    for address in addresses[next_index:]:
+        writer.writerow(results.get(address, {"address": address, "error": NO_RESULT_ERROR}))
+    f.flush()
+
+def truncate_partial_row(path: str):
+    """Cut off a last row left incomplete by a crash mid-write, so appends start on a new line (blocking)"""
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            if pos == end and chunk.endswith(b'\n'):
+                return
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                f.truncate(pos - step + newline + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+def load_done_rows(path: str) -> List[Dict]:
+    """Read the rows already written to an output CSV (blocking)"""
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return [
+            {k: row[k] for k in OUTPUT_FIELDNAMES if row.get(k)}
+            for row in csv.DictReader(f)
+        ]
+
+def is_failed_row(row: Dict) -> bool:
+    """Whether an output row records a failed call rather than the model's answer"""
+    return row.get("error", "").startswith((BATCH_FAILED_ERROR, NO_RESULT_ERROR))
+
+def plan_output(output_csv: str, addresses: List[str],
+                resume: bool) -> Optional[Tuple[List[str], Dict[str, Dict], str]]:
+    """Work out what to write: (addresses still to write, known rows, "new"/"append"/"rewrite")
+
+    Returns None if there is nothing to do or the output cannot be resumed (blocking).
+    """
+    if not resume or not os.path.isfile(output_csv) or os.path.getsize(output_csv) == 0:
+        return addresses, {}, "new"
+    
+    truncate_partial_row(output_csv)
+    done_rows = load_done_rows(output_csv)
+    # Rows are written in input order, so an existing output is a prefix of the input
+    if [row.get("address") for row in done_rows] != addresses[:len(done_rows)]:
+        print(f"❌ {output_csv} does not match the start of the input; refusing to resume")
+        return None
+    
+    # Earlier answers (low-confidence ones included) are reused, also for remaining duplicates
+    known = {row["address"]: row for row in done_rows if not is_failed_row(row)}
+    failed = sum(1 for row in done_rows if is_failed_row(row))
+    if failed:
+        # Failed rows sit in the middle of the file; write a complete new copy and swap it in at the end
+        print(f"🔁 Retrying {failed} failed rows; {output_csv} is replaced once the run completes")
+        return addresses, known, "rewrite"
+    
+    if len(done_rows) == len(addresses):
+        print(f"🎉 Nothing left to process; {output_csv} is already complete")
+        return None
+    print(f"⏩ Resuming: {len(done_rows)} rows already in {output_csv}")
+    return addresses[len(done_rows):], known, "append"
+
+def unanswered_addresses(addresses: List[str], known: Dict[str, Dict], local_detect: bool) -> List[str]:
+    """Unique addresses that still need the model; local answers are added to `known`"""
+    # Duplicates and already answered addresses reuse the known result
+    unique_addresses = [a for a in dict.fromkeys(addresses) if a not in known]
+    if not local_detect:
+        return unique_addresses
+    
+    # Addresses with an unambiguous local signal skip the model entirely
+    for address in unique_addresses:
+        result = detect_country_locally(address)
+        if result is not None:
+            known[address] = {"address": address, **result}
+    remaining = [a for a in unique_addresses if a not in known]
+    print(f"🔎 Detected {len(unique_addresses) - len(remaining)} addresses locally")
+    return remaining
+
+def load_addresses(path: str) -> List[str]:
+    """Read non-empty addresses from the first CSV column (blocking)"""
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip header
+        # Blank addresses are dropped here, once, so every batch slot is a real address
+        return [address for row in reader if row and (address := row[0].strip())]
+
+def batch_bounds(items: List[str], size: int, max_chars: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Start/end indices of batches with at most `size` items and, if set, about `max_chars` characters"""
+    bounds = []
+    start = 0
+    used = 0
+    for i, item in enumerate(items):
+        if i > start and (i - start >= size or (max_chars and used + len(item) > max_chars)):
+            bounds.append((start, i))
+            start = i
+            used = 0
+        used += len(item)
+    if start < len(items):
+        bounds.append((start, len(items)))
+    return bounds
 
-def test_connection():
+async def test_connection(model_name: str = VERTEX_MODEL_NAME):
     """Test the connection with a simple address"""
     print("🧪 Testing connection with sample address...")
     try:
+        init_vertex(model_name)
         test_addresses = ["1600 Pennsylvania Avenue, Washington DC"]
-        result = process_addresses_sync(test_addresses)
+        result = await process_addresses(test_addresses)
         print(f"✅ Test successful: {result}")
         return True
     except Exception as e:
         print(f"❌ Test failed: {e}")
         return False
 
-async def main(input_csv: str, output_csv: str, batch_size: int = 10, delay: float = 2.0):
+async def main(input_csv: str, output_csv: str, batch_size: int = 10, delay: float = 2.0,
+               cache_path: Optional[str] = None, model_name: str = VERTEX_MODEL_NAME,
+               max_batch_chars: Optional[int] = None, local_detect: bool = True, resume: bool = False):
     """Main processing function"""
     if not os.path.isfile(input_csv):
         print(f"❌ Input file not found: {input_csv}")
@@ -258,13 +680,8 @@ async def main(input_csv: str, output_csv: str, batch_size: int = 10, delay: flo
     
     # Read addresses
     print(f"📖 Reading addresses from {input_csv}...")
-    addresses = []
-    async with aiofiles.open(input_csv, 'r', encoding='utf-8') as f:
-        reader = AsyncReader(f)
-        await reader.__anext__()  # Skip header
-        async for row in reader:
-            if row and row[0].strip():
-                addresses.append(row[0].strip())
+    loop = asyncio.get_event_loop()
+    addresses = await loop.run_in_executor(None, load_addresses, input_csv)
     
     if not addresses:
         print("❌ No addresses found")
@@ -272,27 +689,53 @@ async def main(input_csv: str, output_csv: str, batch_size: int = 10, delay: flo
     
     print(f"📊 Found {len(addresses)} addresses")
     
-    # Create batches
-    batches = create_batches(addresses, batch_size)
-    print(f"📦 Created {len(batches)} batches of {batch_size} addresses each")
+    # Overwrite by default; with resume, pick up where an earlier run on this input stopped
+    plan = await loop.run_in_executor(None, plan_output, output_csv, addresses, resume)
+    if plan is None:
+        return
+    addresses, known, mode = plan
+    
+    unique_addresses = unanswered_addresses(addresses, known, local_detect)
+    print(f"📊 {len(addresses)} addresses to write ({len(unique_addresses)} unique to process)")
     
-    # Initialize Vertex and test connection
-    if not test_connection():
+    # Create batches (sliced lazily from the computed bounds)
+    bounds = batch_bounds(unique_addresses, batch_size, max_batch_chars)
+    batches = (unique_addresses[start:end] for start, end in bounds)
+    num_batches = len(bounds)
+    print(f"📦 Created {num_batches} batches of up to {batch_size} addresses each")
+    
+    # Initialize Vertex and test connection, unless every row is already answered
+    if unique_addresses and not await test_connection(model_name):
         print("❌ Connection test failed. Please check your configuration.")
         return
     
-    # Process batches sequentially with delays
-    async with aiofiles.open(output_csv, 'w', encoding='utf-8') as f:
-        fieldnames = ["address", "shortForm", "longForm", "confidence", "error"]
-        writer = AsyncDictWriter(f, fieldnames)
-        await writer.writeheader()
-        
-        for i, batch in enumerate(batches, 1):
-            await process_batch_with_delay(batch, i, writer, delay)
+    cache = open_cache(cache_path) if cache_path else None
+    # A rewrite goes to a side file, so the earlier output stays intact until the new one is complete
+    target_csv = output_csv + ".tmp" if mode == "rewrite" else output_csv
+    
+    try:
+        # Process batches sequentially with delays; one writer task owns the output file
+        with open(target_csv, 'a' if mode == "append" else 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, OUTPUT_FIELDNAMES)
+            if mode != "append":
+                writer.writeheader()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 4)
+            writer_task = asyncio.ensure_future(drain_results(queue, writer, f, addresses, known))
+            
+            for i, batch in enumerate(batches, 1):
+                await process_batch_with_delay(batch, i, queue, delay, cache)
+                
+                # Show progress
+                progress = (i / num_batches) * 100
+                print(f"📈 Progress: {i}/{num_batches} batches ({progress:.1f}%)")
             
-            # Show progress
-            progress = (i / len(batches)) * 100
-            print(f"📈 Progress: {i}/{len(batches)} batches ({progress:.1f}%)")
+            await queue.put(None)
+            await writer_task
+    finally:
+        if cache is not None:
+            cache.close()
+    if mode == "rewrite":
+        os.replace(target_csv, output_csv)
     
     print(f"\n🎉 Processing complete! Results saved to {output_csv}")
 
@@ -301,7 +744,15 @@ if __name__ == "__main__":
     parser.add_argument("input_csv", nargs='?', help="Input CSV file with addresses")
     parser.add_argument("output_csv", nargs='?', help="Output CSV file")
     parser.add_argument("--batch-size", type=int, default=10, help="Addresses per batch (default: 10)")
+    parser.add_argument("--max-batch-chars", type=int, default=None,
+                        help="Also cap each batch at roughly this many address characters (default: no cap)")
     parser.add_argument("--delay", type=float, default=2.0, help="Delay between batches in seconds (default: 2.0)")
+    parser.add_argument("--cache", help="SQLite file for caching results across runs (default: disabled)")
+    parser.add_argument("--model", default=VERTEX_MODEL_NAME, help=f"Gemini model name (default: {VERTEX_MODEL_NAME})")
+    parser.add_argument("--no-local-detect", action="store_true",
+                        help="Send every address to the model, even ones with an explicit country or postcode")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run on the same input instead of overwriting the output")
     parser.add_argument("--test", action="store_true", help="Test connection only")
     
     args = parser.parse_args()
@@ -309,7 +760,7 @@ if __name__ == "__main__":
     # Test mode
     if args.test:
         print("🧪 Running connection test...")
-        if test_connection():
+        if asyncio.run(test_connection(args.model)):
             print("🎉 Connection test passed!")
         else:
             print("❌ Connection test failed!")
@@ -325,4 +776,5 @@ if __name__ == "__main__":
     print(f"📝 Batch size: {args.batch_size}")
     print(f"⏱️  Delay between batches: {args.delay}s")
     
-    asyncio.run(main(args.input_csv, args.output_csv, args.batch_size, args.delay))
+    asyncio.run(main(args.input_csv, args.output_csv, args.batch_size, args.delay, args.cache, args.model,
+                     args.max_batch_chars, not args.no_local_detect, args.resume))
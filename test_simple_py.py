@@ -0,0 +1,382 @@
+from pathlib import Path
+from typing import Dict, List
+import asyncio
+import csv
+import enum
+import io
+import sys
+import types
+
+import pytest
+
+
+def _stub_module(name: str, **attrs) -> None:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+
+# simple_py needs the Vertex AI SDK, which requirements.txt does not install. None of these
+# tests reach the real API, so stand in minimal modules when the SDK is missing.
+try:
+    import vertexai  # noqa: F401
+    from google.api_core import exceptions  # noqa: F401
+    from google.oauth2 import credentials  # noqa: F401
+except ImportError:
+    class _GoogleAPICallError(Exception):
+        pass
+
+    _stub_module("vertexai", init=lambda **kwargs: None)
+    _stub_module(
+        "vertexai.generative_models",
+        FinishReason=enum.Enum("FinishReason", "STOP MAX_TOKENS"),
+        GenerationConfig=lambda **kwargs: kwargs,
+        GenerativeModel=lambda *args, **kwargs: None,
+    )
+    _stub_module("google")
+    _stub_module("google.api_core")
+    _stub_module(
+        "google.api_core.exceptions",
+        GoogleAPICallError=_GoogleAPICallError,
+        **{name: type(name, (_GoogleAPICallError,), {}) for name in (
+            "TooManyRequests", "ResourceExhausted", "ServiceUnavailable",
+            "DeadlineExceeded", "InternalServerError", "Aborted",
+        )},
+    )
+    _stub_module("google.oauth2")
+    _stub_module("google.oauth2.credentials", Credentials=lambda **kwargs: types.SimpleNamespace(**kwargs))
+    sys.modules["google"].api_core = sys.modules["google.api_core"]
+    sys.modules["google.api_core"].exceptions = sys.modules["google.api_core.exceptions"]
+    sys.modules["google"].oauth2 = sys.modules["google.oauth2"]
+
+# Ensure the repo root is importable when running tests from elsewhere
+ROOT = Path(__file__).resolve().parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import simple_py  # noqa: E402
+from simple_py import detect_country_locally  # noqa: E402
+
+
+def test_detect_country_handles_dotted_capital_i() -> None:
+    assert detect_country_locally("İSTANBUL, TÜRKİYE")["shortForm"] == "TR"
+    assert detect_country_locally("Ankara, TURKİYE")["shortForm"] == "TR"
+    assert detect_country_locally("New Delhi, İNDIA")["shortForm"] == "IN"
+
+
+@pytest.mark.parametrize(
+    "address, code, confidence",
+    [
+        ("10 Downing Street, London SW1A 2AA, UK", "GB", 1.0),
+        ("10 Downing Street, London, SW1A 2AA", "GB", 0.9),
+        ("1600 Pennsylvania Avenue NW, Washington, DC 20500", "US", 0.9),
+        ("100 Main St, Toronto, ON M5V 3L9", "CA", 0.9),
+        ("1 George St, Sydney, NSW, 2000", "AU", 0.9),
+        ("〒105-0011 東京都港区芝公園4-2-8", "JP", 0.9),
+        ("Via Roma 1, 00100 Roma, Italy", "IT", 1.0),
+        ("Av. José Larco 123, Miraflores, Perú", "PE", 1.0),
+    ],
+)
+def test_detect_country_answers_unambiguous_addresses(address: str, code: str, confidence: float) -> None:
+    result = detect_country_locally(address)
+    assert result is not None
+    assert result["shortForm"] == code
+    assert result["confidence"] == confidence
+
+
+@pytest.mark.parametrize(
+    "address",
+    [
+        "some random street",
+        "Paris, Texas",
+        "123 Main St, Holland",
+        "Tour Eiffel, Champ de Mars, 5 Av. Anatole France, 75007 Paris",
+        "Boulevard Zerktouni, 20250 Casablanca",
+        "Calle Mayor 5, 28013 Madrid",
+        "Calle 5 de Mayo 10, Centro, 06000",
+        "123 Main St, Peru",
+        "Musterstraße 5, 12345 Berlin",
+        "Bahnhofstraße 1, 39100 Bozen",
+        "Bahnhofplatz 1, 39012 Meran",
+        "Lindenweg 2, 75008 Paris",
+    ],
+)
+def test_detect_country_leaves_ambiguous_addresses_to_model(address: str) -> None:
+    assert detect_country_locally(address) is None
+
+
+def _write_input(path: Path, addresses: List[str]) -> None:
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["address"])
+        writer.writerows((address,) for address in addresses)
+
+
+def _read_output(path: Path) -> List[Dict[str, str]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def _fake_model(monkeypatch: pytest.MonkeyPatch) -> List[List[str]]:
+    """Replace the Gemini call with a canned answer and record what was sent"""
+    calls: List[List[str]] = []
+
+    async def process_addresses(addresses: List[str]) -> Dict:
+        calls.append(list(addresses))
+        return {"results": [{"shortForm": "US", "longForm": "United States", "confidence": 0.95} for _ in addresses]}
+
+    async def test_connection(model_name: str = simple_py.VERTEX_MODEL_NAME) -> bool:
+        return True
+
+    monkeypatch.setattr(simple_py, "process_addresses", process_addresses)
+    monkeypatch.setattr(simple_py, "test_connection", test_connection)
+    return calls
+
+
+def _run(input_csv: Path, output_csv: Path, resume: bool = True) -> None:
+    asyncio.run(simple_py.main(str(input_csv), str(output_csv), batch_size=2, delay=0, local_detect=False,
+                               resume=resume))
+
+
+def test_resume_drops_partially_written_last_row(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = _fake_model(monkeypatch)
+    input_csv = tmp_path / "in.csv"
+    output_csv = tmp_path / "out.csv"
+    _write_input(input_csv, ["a1", "a2", "a1", "a2"])
+    # Simulate a crash mid-row: the second row was only partly flushed
+    output_csv.write_text("address,shortForm,longForm,confidence,error\r\na1,US,United States,0.95,\r\na2,ZZ,Z")
+
+    _run(input_csv, output_csv)
+
+    rows = _read_output(output_csv)
+    assert [row["address"] for row in rows] == ["a1", "a2", "a1", "a2"]
+    assert all(row["shortForm"] == "US" for row in rows)
+    assert calls == [["a2"]]
+
+
+def test_resume_retries_only_failed_rows(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = _fake_model(monkeypatch)
+    input_csv = tmp_path / "in.csv"
+    output_csv = tmp_path / "out.csv"
+    _write_input(input_csv, ["a1", "a2", "a3", "a4", "a5"])
+    output_csv.write_text(
+        "address,shortForm,longForm,confidence,error\r\n"
+        "a1,US,United States,0.95,\r\n"
+        "a2,,,,Batch failed: 401 Unauthorized\r\n"
+        "a3,US,United States,0.95,\r\n"
+        "a4,,,,Low confidence or processing error\r\n"
+    )
+
+    _run(input_csv, output_csv)
+
+    rows = _read_output(output_csv)
+    assert [row["address"] for row in rows] == ["a1", "a2", "a3", "a4", "a5"]
+    assert [row["shortForm"] for row in rows] == ["US", "US", "US", "", "US"]
+    # A low-confidence row is the model's answer, so only the failed and missing rows reach the model
+    assert calls == [["a2", "a5"]]
+    assert not (tmp_path / "out.csv.tmp").exists()
+
+
+def test_resume_of_complete_output_with_low_confidence_rows_does_nothing(
+        tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = _fake_model(monkeypatch)
+    input_csv = tmp_path / "in.csv"
+    output_csv = tmp_path / "out.csv"
+    _write_input(input_csv, ["a1", "a2"])
+    content = (
+        b"address,shortForm,longForm,confidence,error\r\n"
+        b"a1,,,,Low confidence or processing error\r\n"
+        b"a2,US,United States,0.95,\r\n"
+    )
+    output_csv.write_bytes(content)
+
+    _run(input_csv, output_csv)
+
+    assert output_csv.read_bytes() == content
+    assert calls == []
+
+
+def test_existing_output_is_overwritten_without_resume(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = _fake_model(monkeypatch)
+    input_csv = tmp_path / "in.csv"
+    output_csv = tmp_path / "out.csv"
+    _write_input(input_csv, ["b1", "b2"])
+    output_csv.write_text("address,shortForm,longForm,confidence,error\r\na1,FR,France,0.95,\r\n")
+
+    _run(input_csv, output_csv, resume=False)
+
+    assert [row["address"] for row in _read_output(output_csv)] == ["b1", "b2"]
+    assert calls == [["b1", "b2"]]
+
+
+def test_cache_lookup_handles_more_keys_than_sqlite_variable_limit(tmp_path: Path) -> None:
+    conn = simple_py.open_cache(str(tmp_path / "cache.db"))
+    try:
+        addresses = [f"{i} Main St" for i in range(1200)]
+        simple_py.cache_store(conn, {a: {"shortForm": "US", "longForm": "United States", "confidence": 0.9}
+                                     for a in addresses[::2]})
+
+        found = simple_py.cache_lookup(conn, addresses)
+
+        assert set(found) == set(addresses[::2])
+    finally:
+        conn.close()
+
+
+def test_skips_connection_test_when_nothing_needs_the_model(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    async def unavailable(model_name: str = simple_py.VERTEX_MODEL_NAME) -> bool:
+        return False
+
+    monkeypatch.setattr(simple_py, "test_connection", unavailable)
+    input_csv = tmp_path / "in.csv"
+    output_csv = tmp_path / "out.csv"
+    _write_input(input_csv, ["10 Downing Street, London SW1A 2AA, UK", "Via Roma 1, 00100 Roma, Italy"])
+
+    asyncio.run(simple_py.main(str(input_csv), str(output_csv), delay=0))
+
+    rows = _read_output(output_csv)
+    assert [row["shortForm"] for row in rows] == ["GB", "IT"]
+
+
+def _fake_generate(monkeypatch: pytest.MonkeyPatch, generate) -> None:
+    monkeypatch.setattr(simple_py, "init_vertex", lambda model_name=simple_py.VERTEX_MODEL_NAME: None)
+    monkeypatch.setattr(simple_py, "generate_with_retry", generate)
+
+
+def test_process_addresses_propagates_api_errors(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def generate(prompt: str):
+        raise simple_py.gexc.ServiceUnavailable("503 unavailable")
+
+    _fake_generate(monkeypatch, generate)
+
+    with pytest.raises(simple_py.gexc.ServiceUnavailable):
+        asyncio.run(simple_py.process_addresses(["a1"]))
+
+
+def test_process_addresses_falls_back_to_unknown_on_bad_json(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def generate(prompt: str):
+        return types.SimpleNamespace(text="not json")
+
+    _fake_generate(monkeypatch, generate)
+
+    result = asyncio.run(simple_py.process_addresses(["a1", "a2"]))
+
+    assert [r["shortForm"] for r in result["results"]] == ["UNKNOWN", "UNKNOWN"]
+
+
+def test_truncated_response_splits_batch_and_keeps_order(monkeypatch: pytest.MonkeyPatch) -> None:
+    prompts: List[List[str]] = []
+
+    async def generate(prompt: str):
+        addresses = simple_py.json_loads(prompt)
+        prompts.append(addresses)
+        if len(addresses) == 3:
+            truncated = types.SimpleNamespace(finish_reason=simple_py.FinishReason.MAX_TOKENS)
+            return types.SimpleNamespace(candidates=[truncated], text='{"results": [{"shortForm": "US"')
+        results = [{"shortForm": "US", "longForm": address, "confidence": 0.95} for address in addresses]
+        return types.SimpleNamespace(candidates=[], text=simple_py.json_dumps({"results": results}))
+
+    _fake_generate(monkeypatch, generate)
+
+    result = asyncio.run(simple_py.process_addresses(["a", "b", "c"]))
+
+    assert prompts == [["a", "b", "c"], ["a"], ["b", "c"]]
+    assert [r["longForm"] for r in result["results"]] == ["a", "b", "c"]
+
+
+def test_duplicates_across_batches_are_written_in_input_order(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = _fake_model(monkeypatch)
+    input_csv = tmp_path / "in.csv"
+    output_csv = tmp_path / "out.csv"
+    addresses = ["a1", "a2", "a3", "a1", "a4", "a2", "a3"]
+    _write_input(input_csv, addresses)
+
+    _run(input_csv, output_csv, resume=False)
+
+    rows = _read_output(output_csv)
+    assert [row["address"] for row in rows] == addresses
+    assert all(row["shortForm"] == "US" for row in rows)
+    # Each unique address is sent once; its duplicates reuse the answer
+    assert calls == [["a1", "a2"], ["a3", "a4"]]
+
+
+def test_drain_results_marks_addresses_without_a_result() -> None:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, simple_py.OUTPUT_FIELDNAMES)
+
+    async def drain() -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+        await queue.put({"address": "a2", "shortForm": "US", "longForm": "United States", "confidence": 0.95})
+        await queue.put(None)
+        await simple_py.drain_results(queue, writer, out, ["a1", "a2", "a1"])
+
+    asyncio.run(drain())
+
+    out.seek(0)
+    rows = list(csv.DictReader(out, simple_py.OUTPUT_FIELDNAMES))
+    assert [(row["address"], row["shortForm"], row["error"]) for row in rows] == [
+        ("a1", "", simple_py.NO_RESULT_ERROR),
+        ("a2", "US", ""),
+        ("a1", "", simple_py.NO_RESULT_ERROR),
+    ]
+
+
+def test_retry_delay_is_capped(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(simple_py.random, "uniform", lambda low, high: high)
+
+    assert simple_py.retry_delay(0, Exception()) == simple_py.BACKOFF_BASE
+    assert simple_py.retry_delay(20, Exception()) == simple_py.BACKOFF_CAP
+
+
+def test_retry_delay_honours_retry_after(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(simple_py.random, "uniform", lambda low, high: high)
+    error = simple_py.gexc.TooManyRequests("429 throttled")
+    error.response = types.SimpleNamespace(headers={"retry-after": "30"})
+
+    assert simple_py.retry_delay(0, error) == 30.0
+
+
+def _fake_vertex(monkeypatch: pytest.MonkeyPatch, outcomes: List) -> List[float]:
+    """Make the model raise or return each outcome in turn; return the backoff sleeps"""
+    sleeps: List[float] = []
+
+    def generate_content(prompt: str):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def sleep(delay: float) -> None:
+        sleeps.append(delay)
+
+    monkeypatch.setattr(simple_py, "_vertex_model", types.SimpleNamespace(generate_content=generate_content))
+    monkeypatch.setattr(simple_py.asyncio, "sleep", sleep)
+    return sleeps
+
+
+def test_generate_with_retry_retries_transient_errors(monkeypatch: pytest.MonkeyPatch) -> None:
+    outcomes = [simple_py.gexc.ServiceUnavailable("503"), simple_py.gexc.TooManyRequests("429"), "ok"]
+    sleeps = _fake_vertex(monkeypatch, outcomes)
+
+    assert asyncio.run(simple_py.generate_with_retry("[]")) == "ok"
+    assert len(sleeps) == 2
+
+
+def test_generate_with_retry_gives_up_after_max_retries(monkeypatch: pytest.MonkeyPatch) -> None:
+    outcomes = [simple_py.gexc.ServiceUnavailable("503") for _ in range(simple_py.MAX_RETRIES + 2)]
+    sleeps = _fake_vertex(monkeypatch, outcomes)
+
+    with pytest.raises(simple_py.gexc.ServiceUnavailable):
+        asyncio.run(simple_py.generate_with_retry("[]"))
+    assert len(sleeps) == simple_py.MAX_RETRIES
+    assert len(outcomes) == 1
+
+
+def test_generate_with_retry_does_not_retry_other_errors(monkeypatch: pytest.MonkeyPatch) -> None:
+    outcomes = [ValueError("400 invalid argument"), "ok"]
+    sleeps = _fake_vertex(monkeypatch, outcomes)
+
+    with pytest.raises(ValueError):
+        asyncio.run(simple_py.generate_with_retry("[]"))
+    assert sleeps == []
+    assert outcomes == ["ok"]